@@ -0,0 +1,142 @@
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+from dotenv import load_dotenv
+
+# Configuration
+load_dotenv()
+CACHE_PATH = os.getenv("CACHE_PATH", "./answer_cache")
+
+
+def question_hash(question: str) -> str:
+    return hashlib.sha256(question.encode("utf-8")).hexdigest()
+
+
+def clear_answer_cache() -> None:
+    """Remove all cached answers, e.g. because the notes were re-indexed."""
+    shutil.rmtree(CACHE_PATH, ignore_errors=True)
+
+
+class AnswerCache:
+    """On-disk cache of answers to previously asked questions.
+
+    An answer is found by an exact match on the question text, or by a
+    question embedding with a cosine similarity of at least threshold.
+    The normalized embeddings are rows of a memory-mapped float32 matrix;
+    embeddings.json holds its row count and size, and each line of
+    answers.jsonl refers to its row.
+    """
+
+    def __init__(
+        self, path: str = CACHE_PATH, threshold: float = 0.97, capacity: int = 1024
+    ):
+        self.path = path
+        self.answers_file = os.path.join(path, "answers.jsonl")
+        self.embeddings_file = os.path.join(path, "embeddings.f32")
+        self.meta_file = os.path.join(path, "embeddings.json")
+        self.threshold = threshold
+        self.capacity = capacity
+        self._load()
+
+    def _load(self):
+        """Read the cache from disk, keeping what survived an interrupted write.
+
+        A missing or short embedding file (e.g. cleared while an answer was
+        being added) holds fewer rows, and a truncated last answer is dropped.
+        """
+        self.embeddings = None
+        self.count = 0
+        self.entries = []
+
+        meta = None
+        if os.path.isfile(self.meta_file):
+            try:
+                with open(self.meta_file, "r", encoding="utf-8") as f:
+                    meta = json.load(f)
+            except json.JSONDecodeError:
+                pass
+        if meta:
+            row_bytes = meta["dim"] * np.dtype(np.float32).itemsize
+            if (
+                os.path.isfile(self.embeddings_file)
+                and os.path.getsize(self.embeddings_file) >= row_bytes
+            ):
+                self._open_embeddings(meta["dim"])
+                self.count = min(meta["count"], len(self.embeddings))
+        if os.path.isfile(self.answers_file):
+            with open(self.answers_file, "rb+") as f:
+                end = 0
+                for line in f:
+                    try:
+                        entry = json.loads(line) if line.endswith(b"\n") else None
+                    except json.JSONDecodeError:
+                        entry = None
+                    if entry is None:
+                        # Cut off the partial line, so the next answer is
+                        # appended on a line of its own
+                        f.truncate(end)
+                        break
+                    self.entries.append(entry)
+                    end += len(line)
+        self.by_hash = {entry["sha"]: entry for entry in self.entries}
+        self.by_row = {
+            entry["row"]: entry for entry in self.entries if entry["row"] < self.count
+        }
+
+    def _open_embeddings(self, dim: int, min_rows: int = 0):
+        """Memory-map the embedding file, growing it to hold at least min_rows."""
+        row_bytes = dim * np.dtype(np.float32).itemsize
+        rows = 0
+        if os.path.isfile(self.embeddings_file):
+            rows = os.path.getsize(self.embeddings_file) // row_bytes
+        if rows < min_rows:
+            # Grow geometrically, so appending rows rarely resizes the file
+            rows = max(min_rows, 2 * rows, self.capacity)
+            with open(self.embeddings_file, "ab") as f:
+                f.truncate(rows * row_bytes)
+        self.embeddings = np.memmap(
+            self.embeddings_file, dtype=np.float32, mode="r+", shape=(rows, dim)
+        )
+
+    def get_exact(self, question: str) -> dict | None:
+        return self.by_hash.get(question_hash(question))
+
+    def get_similar(self, embedding: np.ndarray) -> dict | None:
+        if not self.count:
+            return None
+        sims = self.embeddings[: self.count] @ (embedding / np.linalg.norm(embedding))
+        best = int(np.argmax(sims))
+        return self.by_row.get(best) if sims[best] >= self.threshold else None
+
+    def add(self, question: str, embedding: np.ndarray, source: str, answer: str):
+        if self.embeddings is not None and not os.path.isfile(self.embeddings_file):
+            # Cleared (e.g. by index.py) since it was read; start over instead
+            # of writing to the removed file
+            self._load()
+        os.makedirs(self.path, exist_ok=True)
+        if self.embeddings is None or self.count == len(self.embeddings):
+            self._open_embeddings(len(embedding), self.count + 1)
+
+        # Write the row before the answer that refers to it; an interrupted
+        # add leaves at most an unreferenced row behind
+        row = self.count
+        self.embeddings[row] = embedding / np.linalg.norm(embedding)
+        self.embeddings.flush()
+        self.count += 1
+        with open(self.meta_file, "w", encoding="utf-8") as f:
+            json.dump({"count": self.count, "dim": len(embedding)}, f)
+
+        entry = {
+            "sha": question_hash(question),
+            "row": row,
+            "question": question,
+            "source": source,
+            "answer": answer,
+        }
+        with open(self.answers_file, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self.entries.append(entry)
+        self.by_hash[entry["sha"]] = entry
+        self.by_row[row] = entry
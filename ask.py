@@ -1,23 +1,47 @@
+import argparse
+import asyncio
 import os
 import re
+import threading
+from collections.abc import Iterator
+from functools import lru_cache
 from chromadb.config import Settings
+from chromadb.errors import NotFoundError
 import chromadb
-from sentence_transformers import SentenceTransformer
+import httpx
+import numpy as np
 import ollama
 from dotenv import load_dotenv
+from embedding import COLLECTION_METADATA, is_current_collection
+from answer_cache import AnswerCache
 
 # Configuration
 load_dotenv()
 NOTES_PATH = os.getenv("NOTES_PATH", "./notes")
 CHROMA_PATH = os.getenv("CHROMA_PATH", "./chroma_data")
+EMBED_SOCKET = os.getenv("EMBED_SOCKET", "/tmp/notes-rag-embed.sock")
 
-# Initialize embedding model (BGE-M3: best cross-lingual alignment, 567M params)
-model = SentenceTransformer("BAAI/bge-m3")
+# The embedding model is only loaded when the embedding server is not running
+# (see embedding.py for the available backends); warm_up_model decides
+_model = None
+_model_lock = threading.Lock()
+_use_server = False
 
 client = chromadb.PersistentClient(
     path=CHROMA_PATH,
     settings=Settings(anonymized_telemetry=False),
 )
+try:
+    collection = client.get_collection("notes")
+except NotFoundError:
+    raise SystemExit("No notes collection found. Run index.py first.")
+# Question embeddings are only comparable with notes embedded by the same
+# backend, and older chunk metadata lacks what the queries below rely on
+if not is_current_collection(collection.metadata):
+    raise SystemExit(
+        "Notes were indexed with another embedding backend or index format. "
+        "Re-run index.py."
+    )
 
 
 # Helper functions
@@ -37,102 +61,183 @@ def full_notes_path(source: str) -> str:
     return os.path.join(NOTES_PATH, source)
 
 
+@lru_cache(maxsize=256)
+def _read_file_cached(path: str, mtime_ns: int) -> str:
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+
 def read_file_contents(path: str) -> str:
     if not os.path.isfile(path):
         raise FileNotFoundError(f"No such file: {path}")
-    with open(path, "r", encoding="utf-8") as f:
-        return f.read()
+    # Keyed on mtime so an edited note is read again
+    return _read_file_cached(path, os.stat(path).st_mtime_ns)
 
 
-def print_sources_and_titles(data):
-    for item in data:
-        print(item.get("source") + ": " + item.get("title"))
+def get_model():
+    global _model
+    with _model_lock:
+        if _model is None:
+            # Imported here so that startup doesn't load the embedding runtime
+            from embedding import load_embedding_model
 
+            _model = load_embedding_model()
+    return _model
 
-# Main workflow functions
-def query_chromadb(question: str, n_results: int = 8) -> list[dict]:
-    """Query ChromaDB with the question directly and return results with distances."""
-    collection = client.get_collection("notes")
 
-    # Embed the question directly (no keyword extraction)
-    q_embedding = model.encode([question], convert_to_tensor=False)[0].tolist()
+def embed_server_client() -> httpx.Client:
+    return httpx.Client(transport=httpx.HTTPTransport(uds=EMBED_SOCKET))
 
-    # Query ChromaDB
-    results = collection.query(
-        query_embeddings=[q_embedding],
-        n_results=n_results,
-        include=["documents", "metadatas", "distances"],
-    )
 
-    # Extract results
-    docs = results.get("documents")
-    if not isinstance(docs, (list, tuple)):
-        docs = []
-    documents = docs[0] if docs and isinstance(docs[0], (list, tuple)) else list(docs)
-
-    metas = results.get("metadatas")
-    if not isinstance(metas, (list, tuple)):
-        metas = []
-    metadatas = (
-        metas[0] if metas and isinstance(metas[0], (list, tuple)) else list(metas)
-    )
+def embed_server_backend() -> str | None:
+    """Return the embedding backend of embed_server.py, if it is running."""
+    if not os.path.exists(EMBED_SOCKET):
+        return None
+    try:
+        with embed_server_client() as http:
+            response = http.get("http://embed-server/health")
+            response.raise_for_status()
+    except httpx.HTTPError:
+        # E.g. a socket file left behind by a server that is gone
+        return None
+    return response.json().get("embedding_backend")
 
-    dists = results.get("distances")
-    if not isinstance(dists, (list, tuple)):
-        dists = []
-    distances = (
-        dists[0] if dists and isinstance(dists[0], (list, tuple)) else list(dists)
-    )
 
-    def _as_tags(value) -> list[str]:
-        if isinstance(value, list):
-            return [str(t).strip() for t in value if str(t).strip()]
-        if isinstance(value, str):
-            return [t.strip() for t in value.split(",") if t.strip()]
+def warm_up_model() -> None:
+    """Choose between the embedding server and the local model.
+
+    The local model is loaded, and run once on a throwaway text so the first
+    real question doesn't pay for it, unless embed_server.py is running with
+    the same backend as the index.
+    """
+    global _use_server
+    backend = embed_server_backend()
+    if backend == COLLECTION_METADATA["embedding_backend"]:
+        _use_server = True
+        return
+    if backend is not None:
+        print(f"Not using the embedding server, it embeds with {backend}")
+    get_model().encode(["warmup"])
+
+
+def embed_with_server(question: str) -> np.ndarray | None:
+    """Embed a question with embed_server.py."""
+    try:
+        with embed_server_client() as http:
+            response = http.post("http://embed-server/embed", json={"text": question})
+            response.raise_for_status()
+    except httpx.HTTPError:
+        return None
+    return np.asarray(response.json(), dtype=np.float32)
+
+
+@lru_cache(maxsize=1024)
+def embed_question(question: str) -> np.ndarray:
+    """Embed a question, reusing the embedding for repeated questions."""
+    embedding = embed_with_server(question) if _use_server else None
+    if embedding is None:
+        embedding = get_model().encode([question])[0]
+    # The array is shared between cache hits, so guard it against mutation
+    embedding.setflags(write=False)
+    return embedding
+
+
+def _first_query_result(results: dict, key: str) -> list:
+    """Return the values of a Chroma query result for the first query embedding."""
+    values = results.get(key)
+    if not isinstance(values, (list, tuple)):
+        values = []
+    if values and isinstance(values[0], (list, tuple)):
+        return values[0]
+    return list(values)
+
+
+_TAG_SPLIT = re.compile(r"\s*,\s*")
+
+
+def _as_tags(value) -> list[str]:
+    if isinstance(value, list):
+        tags = (str(t).strip() for t in value)
+    elif isinstance(value, str):
+        tags = _TAG_SPLIT.split(value.strip())
+    else:
         return []
+    # Deduplicate while keeping the order of the tag line
+    return list(dict.fromkeys(t for t in tags if t))
+
+
+def extract_items(results: dict) -> list[dict]:
+    """Flatten a Chroma query result into one dict per chunk."""
+    metadatas = _first_query_result(results, "metadatas")
+    distances = _first_query_result(results, "distances")
 
     items = []
-    for doc, meta, dist in zip(documents, metadatas, distances):
+    for meta, dist in zip(metadatas, distances):
         items.append(
             {
-                "chunk": doc,
                 "title": str(meta.get("title", "")),
                 "source": str(meta.get("source", "")),
                 "tags": _as_tags(meta.get("tags", [])),
+                "preview": str(meta.get("preview", "")),
                 "distance": float(dist),
             }
         )
-
     return items
 
 
-def rerank_with_llm(question: str, candidates: list[dict]) -> int:
-    """Use Ollama to pick the most relevant document from candidates.
+def mmr_select(
+    query_embedding: np.ndarray,
+    embeddings: np.ndarray,
+    k: int,
+    lambda_: float = 0.7,
+) -> list[int]:
+    """Select k rows of embeddings by maximal marginal relevance.
 
-    Returns the index of the best matching candidate.
+    Returns row indices in selection order; the first is the closest match.
     """
-    # Build candidate list for the prompt
-    candidate_descriptions = []
-    for i, c in enumerate(candidates):
-        tags_str = ", ".join(c["tags"]) if c["tags"] else "none"
-        # Show a preview of the chunk (first 200 chars)
-        chunk_preview = c["chunk"][:200].replace("\n", " ")
-        if len(c["chunk"]) > 200:
-            chunk_preview += "..."
-        candidate_descriptions.append(
-            f"[{i}] Title: {c['title']}\n    Tags: {tags_str}\n    Preview: {chunk_preview}"
-        )
+    embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+    sims = embeddings @ (query_embedding / np.linalg.norm(query_embedding))
+    doc_sims = embeddings @ embeddings.T
 
-    candidates_text = "\n\n".join(candidate_descriptions)
+    selected = [int(np.argmax(sims))]
+    available = np.ones(len(embeddings), dtype=bool)
+    available[selected[0]] = False
+    # Highest similarity of each row to any selected row, updated incrementally
+    max_doc_sims = doc_sims[selected[0]].copy()
+
+    while len(selected) < min(k, len(embeddings)):
+        scores = lambda_ * sims - (1 - lambda_) * max_doc_sims
+        scores[~available] = -np.inf
+        idx = int(np.argmax(scores))
+        selected.append(idx)
+        available[idx] = False
+        np.maximum(max_doc_sims, doc_sims[idx], out=max_doc_sims)
 
-    prompt = f"""You are a document retrieval assistant. Given a question and a list of candidate documents, determine which document is most likely to contain the answer.
+    return selected
+
+
+def print_answer_header():
+    print("\n" + "=" * 50)
+    print("Answer:")
+    print("=" * 50)
+
+
+def print_sources_and_titles(data):
+    for item in data:
+        print(item.get("source") + ": " + item.get("title"))
+
+
+# Prompt templates, split around the values filled in per question
+RERANK_PROMPT_HEAD = """You are a document retrieval assistant. Given a question and a list of candidate documents, determine which document is most likely to contain the answer.
 
 <QUESTION>
-{question}
+"""
+RERANK_PROMPT_MID = """
 </QUESTION>
 
 <CANDIDATES>
-{candidates_text}
+"""
+RERANK_PROMPT_TAIL = """
 </CANDIDATES>
 
 Task:
@@ -145,13 +250,109 @@ Output:
 - Do not explain your reasoning
 - If none seem relevant, return 0"""
 
-    ollama_response = ollama.chat(
+ANSWER_PROMPT_HEAD = """Task: High-Fidelity Information Extraction
+
+- Role: You are an objective and precise Research Assistant.
+- Goal: Answer the `<QUESTION>` using **only** the content provided in the `<DOCUMENT>`.
+
+---
+
+Strict Guidelines:
+1. **Groundedness:** Treat the `<DOCUMENT>` as the absolute source of truth. Do not use prior knowledge, external facts, or assumptions. If the document does not contain the answer, respond with: "The provided document does not contain sufficient information to answer this question."
+2. **Output Structure:** - Use **Markdown** for clarity (headers, bullet points, or tables where appropriate).
+   - If the information is a process, use a numbered list.
+   - If the information is a list of items or facts, use bullet points.
+3. **No Meta-Talk:** Do not include introductory phrases (e.g., "According to the document...") or concluding remarks. Provide only the extracted data.
+4. **Verbatim Accuracy:** Retain specific terminology, technical names, dates, and figures exactly as they appear in the source text.
+5. **Conflict Resolution:** If the document contains internal contradictions, report exactly what the text states without trying to resolve the discrepancy.
+
+---
+
+<QUESTION>
+"""
+ANSWER_PROMPT_MID = """
+</QUESTION>
+
+<DOCUMENT>
+"""
+ANSWER_PROMPT_TAIL = """
+<DOCUMENT>
+"""
+
+
+# Main workflow functions
+def query_chromadb(
+    question: str, n_results: int = 8, fetch_k: int = 24, diverse: bool = False
+) -> list[dict]:
+    """Query ChromaDB with the question directly and return results with distances.
+
+    With diverse, the fetch_k nearest chunks are narrowed down to n_results
+    with MMR, so the candidates are not all near-duplicate chunks of the same
+    note. Otherwise the n_results nearest chunks are returned.
+    """
+    # Embed the question directly (no keyword extraction)
+    q_embedding = embed_question(question)
+
+    # Query ChromaDB; the chunk embeddings are only needed for MMR
+    if not diverse:
+        results = collection.query(
+            query_embeddings=q_embedding.reshape(1, -1),
+            n_results=n_results,
+            include=["metadatas", "distances"],
+        )
+        return extract_items(results)
+    results = collection.query(
+        query_embeddings=q_embedding.reshape(1, -1),
+        n_results=fetch_k,
+        include=["metadatas", "distances", "embeddings"],
+    )
+
+    items = extract_items(results)
+    if not items:
+        return items
+    embeddings = np.asarray(results["embeddings"][0], dtype=np.float32)
+    return [items[i] for i in mmr_select(q_embedding, embeddings, n_results)]
+
+
+async def rerank_with_llm(question: str, candidates: list[dict]) -> int:
+    """Use Ollama to pick the most relevant document from candidates.
+
+    Returns the index of the best matching candidate.
+    """
+    # Build candidate list for the prompt
+    candidate_descriptions = []
+    for i, c in enumerate(candidates):
+        tags_str = ", ".join(c["tags"]) if c["tags"] else "none"
+        # The preview (first 200 chars of the chunk) is stored at index time
+        candidate_descriptions.append(
+            f"[{i}] Title: {c['title']}\n    Tags: {tags_str}\n    Preview: {c['preview']}"
+        )
+
+    candidates_text = "\n\n".join(candidate_descriptions)
+
+    prompt = "".join(
+        (
+            RERANK_PROMPT_HEAD,
+            question,
+            RERANK_PROMPT_MID,
+            candidates_text,
+            RERANK_PROMPT_TAIL,
+        )
+    )
+
+    # Stream the response so generation can be stopped as soon as the number
+    # is complete, instead of waiting for any explanation the model adds.
+    response_text = ""
+    async for chunk in await ollama.AsyncClient().chat(
         model="llama3.1",
         messages=[{"role": "user", "content": prompt}],
         options={"temperature": 0},
-    )
-
-    response_text = ollama_response["message"]["content"].strip()
+        stream=True,
+    ):
+        response_text += chunk["message"]["content"]
+        match = re.search(r"\d+", response_text)
+        if match and match.end() < len(response_text):
+            break
 
     # Parse the response - extract the number
     try:
@@ -168,6 +369,31 @@ Output:
     return 0
 
 
+async def rerank_and_prefetch(
+    question: str, candidates: list[dict], prefetch: int = 5
+) -> tuple[int, str]:
+    """Re-rank the candidates while reading the top candidates' notes from disk.
+
+    Returns the index of the best matching candidate and its document content.
+    """
+    sources = list(dict.fromkeys(c["source"] for c in candidates[:prefetch]))
+    best_idx, *contents = await asyncio.gather(
+        rerank_with_llm(question, candidates),
+        *(asyncio.to_thread(get_document_content, source) for source in sources),
+        return_exceptions=True,
+    )
+    if isinstance(best_idx, BaseException):
+        raise best_idx
+
+    # Only a failed read of the selected note is an error
+    prefetched = dict(zip(sources, contents))
+    source = candidates[best_idx]["source"]
+    content = prefetched.get(source)
+    if content is None or isinstance(content, BaseException):
+        content = get_document_content(source)
+    return best_idx, content
+
+
 def check_confidence(results: list[dict], threshold: float = 1.0) -> tuple[bool, float]:
     """Check if the top result has sufficient confidence based on distance.
 
@@ -180,6 +406,16 @@ def check_confidence(results: list[dict], threshold: float = 1.0) -> tuple[bool,
     return best_distance <= threshold, best_distance
 
 
+def has_clear_winner(results: list[dict], margin: float = 0.15) -> bool:
+    """Check if the top result is closer than any other source by at least margin.
+
+    When it is, re-ranking with the LLM would not change the outcome.
+    """
+    top = results[0]
+    others = [r["distance"] for r in results[1:] if r["source"] != top["source"]]
+    return not others or min(others) - top["distance"] > margin
+
+
 def get_document_content(source: str) -> str:
     """Retrieve the full content of a document from its source path."""
     cleaned_source = strip_leading_slash(strip_surrounding_quotes(source))
@@ -187,52 +423,64 @@ def get_document_content(source: str) -> str:
     return read_file_contents(notes_file)
 
 
-def get_final_answer(question: str, document_content: str) -> str:
-    """Use Ollama to extract the answer from the document."""
-    prompt = f"""Task: High-Fidelity Information Extraction
+def get_final_answer(question: str, document_content: str) -> Iterator[str]:
+    """Use Ollama to extract the answer from the document.
 
-- Role: You are an objective and precise Research Assistant.
-- Goal: Answer the `<QUESTION>` using **only** the content provided in the `<DOCUMENT>`.
-
----
-
-Strict Guidelines:
-1. **Groundedness:** Treat the `<DOCUMENT>` as the absolute source of truth. Do not use prior knowledge, external facts, or assumptions. If the document does not contain the answer, respond with: "The provided document does not contain sufficient information to answer this question."
-2. **Output Structure:** - Use **Markdown** for clarity (headers, bullet points, or tables where appropriate).
-   - If the information is a process, use a numbered list.
-   - If the information is a list of items or facts, use bullet points.
-3. **No Meta-Talk:** Do not include introductory phrases (e.g., "According to the document...") or concluding remarks. Provide only the extracted data.
-4. **Verbatim Accuracy:** Retain specific terminology, technical names, dates, and figures exactly as they appear in the source text.
-5. **Conflict Resolution:** If the document contains internal contradictions, report exactly what the text states without trying to resolve the discrepancy.
-
----
-
-<QUESTION>
-{question}
-</QUESTION>
-
-<DOCUMENT>
-{document_content}
-<DOCUMENT>
-"""
+    The answer is streamed, yielding text as soon as Ollama generates it.
+    """
+    prompt = "".join(
+        (
+            ANSWER_PROMPT_HEAD,
+            question,
+            ANSWER_PROMPT_MID,
+            document_content,
+            ANSWER_PROMPT_TAIL,
+        )
+    )
 
-    ollama_response = ollama.chat(
+    for chunk in ollama.chat(
         model="llama3.1",
         messages=[{"role": "user", "content": prompt}],
         options={"temperature": 0},
-    )
-    return ollama_response["message"]["content"]
+        stream=True,
+    ):
+        yield chunk["message"]["content"]
 
 
 def main():
     """Main execution flow."""
+    parser = argparse.ArgumentParser(description="Ask a question about your notes.")
+    parser.add_argument(
+        "--llm-rerank",
+        action="store_true",
+        help="let Ollama pick the best candidate instead of the closest match",
+    )
+    args = parser.parse_args()
+
+    # Warm up the model while the user is typing the question
+    warmup = threading.Thread(target=warm_up_model, daemon=True)
+    warmup.start()
+
     # Get question from user
     print("Ask a question about your notes")
     question = input()
 
+    # Reuse the answer to an identical or near-identical earlier question
+    cache = AnswerCache()
+    cached = cache.get_exact(question)
+    if not cached:
+        # Don't encode concurrently with the warm-up; wait for it to finish
+        warmup.join()
+        cached = cache.get_similar(embed_question(question))
+    if cached:
+        print(f"Answered before from {cached['source']}: {cached['question']}")
+        print_answer_header()
+        print(cached["answer"])
+        return
+
     # Query RAG directly with the question (no keyword extraction)
     print("Searching notes...")
-    results = query_chromadb(question)
+    results = query_chromadb(question, diverse=args.llm_rerank)
 
     if not results:
         print("No results found in your notes.")
@@ -252,23 +500,34 @@ def main():
         print(f"[{i}] {r['source']}: {r['title']} (dist: {r['distance']:.3f})")
     print("----------------------\n")
 
-    # LLM re-ranking: let Ollama pick the best document
-    print("Re-ranking candidates...")
-    best_idx = rerank_with_llm(question, results)
+    # The candidates are already in MMR order, so the first is the best match.
+    # With --llm-rerank, Ollama picks the best document instead, unless it is
+    # obvious. Candidate documents are read from disk while Ollama re-ranks.
+    if not args.llm_rerank or has_clear_winner(results):
+        if args.llm_rerank:
+            print("Clear best match, skipping re-ranking")
+        best_idx = 0
+        document_content = get_document_content(results[0]["source"])
+    else:
+        print("Re-ranking candidates...")
+        best_idx, document_content = asyncio.run(
+            rerank_and_prefetch(question, results)
+        )
     selected = results[best_idx]
     print(f"Selected: [{best_idx}] {selected['source']}: {selected['title']}")
 
-    # Retrieve full document content
-    document_content = get_document_content(selected["source"])
-
-    # Get final answer from Ollama
+    # Get final answer from Ollama, printing it while it is generated
     print("\nGenerating answer...")
-    answer = get_final_answer(question, document_content)
-
-    print("\n" + "=" * 50)
-    print("Answer:")
-    print("=" * 50)
-    print(answer)
+    print_answer_header()
+    answer_parts = []
+    for part in get_final_answer(question, document_content):
+        print(part, end="", flush=True)
+        answer_parts.append(part)
+    print()
+
+    cache.add(
+        question, embed_question(question), selected["source"], "".join(answer_parts)
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,24 @@
+from fastapi import FastAPI
+from pydantic import BaseModel
+from embedding import COLLECTION_METADATA, load_embedding_model
+
+# Load and warm up the embedding model once, instead of in every ask.py run
+model = load_embedding_model()
+model.encode(["warmup"])
+
+app = FastAPI()
+
+
+class EmbedRequest(BaseModel):
+    text: str
+
+
+@app.get("/health")
+def health() -> dict:
+    # ask.py only uses the server when it embeds with the backend of the index
+    return {"embedding_backend": COLLECTION_METADATA["embedding_backend"]}
+
+
+@app.post("/embed")
+def embed(request: EmbedRequest) -> list[float]:
+    return model.encode([request.text])[0].tolist()
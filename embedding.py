@@ -0,0 +1,197 @@
+import os
+from typing import TYPE_CHECKING
+import numpy as np
+from dotenv import load_dotenv
+
+# The runtimes are imported where they're used, so that importing this module
+# (e.g. for its configuration) stays cheap and only the configured backend's
+# runtime gets loaded
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
+
+# Configuration (shared by index.py and ask.py so both embed into the same space)
+load_dotenv()
+MODELS_PATH = os.getenv("MODELS_PATH", "./models")
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "onnx")
+EMBEDDING_THREADS = int(os.getenv("EMBEDDING_THREADS") or os.cpu_count() or 1)
+
+# BGE-M3: best cross-lingual alignment, 567M params
+EMBEDDING_MODEL = "BAAI/bge-m3"
+QUANTIZED_MODEL_FILES = {
+    "onnx": "onnx/model_qint8_avx512_vnni.onnx",
+    "openvino": "openvino/openvino_model_qint8_quantized.xml",
+}
+
+# Recorded as the embedding backend of an index. Give a backend a new name when
+# its embeddings change, so only indexes built with that backend are rebuilt.
+BACKEND_VERSIONS = {"model2vec": "model2vec-normalized"}
+
+# Stored with the notes collection by index.py and checked by ask.py; a
+# mismatch means all notes must be re-indexed.
+# Bump metadata_format when the chunk metadata changes.
+COLLECTION_METADATA = {
+    "embedding_backend": BACKEND_VERSIONS.get(EMBEDDING_BACKEND, EMBEDDING_BACKEND),
+    "metadata_format": 2,
+}
+
+
+def is_current_collection(metadata: dict | None) -> bool:
+    """Whether a collection with this metadata was indexed like COLLECTION_METADATA."""
+    metadata = metadata or {}
+    return all(metadata.get(k) == v for k, v in COLLECTION_METADATA.items())
+
+
+def cls_pool_normalize(hidden: np.ndarray) -> np.ndarray:
+    """CLS pooling followed by L2 normalization, as configured for BGE-M3."""
+    # Copy only the CLS rows so the batch's hidden states can be freed, then
+    # normalize that copy in place instead of allocating more arrays
+    cls = hidden[:, 0].copy()
+    cls /= np.sqrt(np.einsum("ij,ij->i", cls, cls))[:, None]
+    return cls
+
+
+def set_torch_threads() -> None:
+    """Use all cores for encoding instead of PyTorch's own default."""
+    import torch
+
+    torch.set_num_threads(EMBEDDING_THREADS)
+
+
+class OnnxEmbedder:
+    """Embed texts with an exported ONNX model through ONNX Runtime directly.
+
+    Skips the SentenceTransformer encode wrapper and its tensor conversions,
+    producing the same embeddings for the exported BGE-M3 model.
+    """
+
+    def __init__(self, model_dir: str, file_name: str):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = EMBEDDING_THREADS
+        options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(
+            os.path.join(model_dir, file_name),
+            sess_options=options,
+            providers=["CPUExecutionProvider"],
+        )
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+    def encode(
+        self,
+        sentences: list[str],
+        batch_size: int = 32,
+        show_progress_bar: bool = False,
+    ) -> np.ndarray:
+        from tqdm import tqdm
+
+        # Batch texts of similar length together to minimize padding
+        order = np.argsort([-len(s) for s in sentences], kind="stable")
+        sorted_sentences = [sentences[i] for i in order]
+
+        batches = []
+        batch_starts = range(0, len(sentences), batch_size)
+        progress = tqdm(batch_starts, desc="Batches", disable=not show_progress_bar)
+        for start in progress:
+            tokens = self.tokenizer(
+                sorted_sentences[start : start + batch_size],
+                padding=True,
+                truncation=True,
+                return_tensors="np",
+            )
+            inputs = {k: v for k, v in tokens.items() if k in self.input_names}
+            hidden = self.session.run(None, inputs)[0]
+            batches.append(cls_pool_normalize(hidden))
+        if not batches:
+            return np.empty((0, 0), dtype=np.float32)
+
+        # Restore the input order
+        sorted_embeddings = np.concatenate(batches)
+        embeddings = np.empty_like(sorted_embeddings)
+        embeddings[order] = sorted_embeddings
+        return embeddings
+
+
+def load_static_model() -> "SentenceTransformer":
+    """Load a model2vec static embedding distilled from the embedding model.
+
+    The distilled model is created once and cached in MODELS_PATH.
+    """
+    from sentence_transformers import SentenceTransformer
+    from sentence_transformers.models import Normalize, StaticEmbedding
+
+    model_dir = os.path.join(MODELS_PATH, "bge-m3-model2vec-normalized")
+    if not os.path.isdir(model_dir):
+        static = StaticEmbedding.from_distillation(EMBEDDING_MODEL, pca_dims=256)
+        # Unit length like the other backends, which the distance thresholds
+        # and MMR in ask.py rely on
+        SentenceTransformer(modules=[static, Normalize()]).save(model_dir)
+    return SentenceTransformer(model_dir)
+
+
+def load_embedding_model() -> "SentenceTransformer | OnnxEmbedder":
+    """Load the embedding model for the configured backend.
+
+    - onnx: int8 (AVX-512 VNNI) dynamically quantized ONNX model, run with
+      ONNX Runtime directly
+    - openvino: int8 statically quantized OpenVINO model
+    - model2vec: static token embeddings, no transformer forward pass
+    - torch: the original PyTorch model, in fp16 on a GPU and fp32 otherwise
+
+    Exported models are created once and cached in MODELS_PATH.
+    """
+    if EMBEDDING_BACKEND == "torch":
+        from sentence_transformers import SentenceTransformer
+
+        set_torch_threads()
+        model = SentenceTransformer(EMBEDDING_MODEL)
+        # fp16 halves memory traffic and runs on tensor cores; CPUs are better
+        # served by the int8 backends
+        if model.device.type == "cuda":
+            model.half()
+        return model
+    if EMBEDDING_BACKEND == "model2vec":
+        set_torch_threads()
+        return load_static_model()
+    if EMBEDDING_BACKEND not in QUANTIZED_MODEL_FILES:
+        raise ValueError(f"Unknown EMBEDDING_BACKEND: {EMBEDDING_BACKEND}")
+
+    file_name = QUANTIZED_MODEL_FILES[EMBEDDING_BACKEND]
+    model_dir = os.path.join(MODELS_PATH, f"bge-m3-{EMBEDDING_BACKEND}")
+    if not os.path.isfile(os.path.join(model_dir, file_name)):
+        # Exporting runs the PyTorch model; a cached export doesn't need it
+        from sentence_transformers import (
+            SentenceTransformer,
+            export_dynamic_quantized_onnx_model,
+            export_static_quantized_openvino_model,
+        )
+
+        set_torch_threads()
+        exported = SentenceTransformer(EMBEDDING_MODEL, backend=EMBEDDING_BACKEND)
+        exported.save_pretrained(model_dir)
+        if EMBEDDING_BACKEND == "onnx":
+            export_dynamic_quantized_onnx_model(exported, "avx512_vnni", model_dir)
+        else:
+            # optimum-intel and datasets are only installed with the openvino extra
+            from optimum.intel import OVQuantizationConfig
+
+            # Calibrate on text in 20 languages, like the notes, instead of
+            # the default English-only SST-2
+            export_static_quantized_openvino_model(
+                exported,
+                OVQuantizationConfig(),
+                model_dir,
+                dataset_name="papluca/language-identification",
+                dataset_config_name="default",
+                dataset_split="validation",
+                column_name="text",
+            )
+    if EMBEDDING_BACKEND == "onnx":
+        return OnnxEmbedder(model_dir, file_name)
+    from sentence_transformers import SentenceTransformer
+
+    return SentenceTransformer(
+        model_dir, backend=EMBEDDING_BACKEND, model_kwargs={"file_name": file_name}
+    )
@@ -1,13 +1,19 @@
+import argparse
 import chromadb
+import hashlib
 import re
 import os
-from pathlib import Path
-from sentence_transformers import SentenceTransformer
+import sqlite3
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
 from chromadb.errors import NotFoundError
 from dotenv import load_dotenv
-
-# Load embedding model (BGE-M3: best cross-lingual alignment, 567M params)
-model = SentenceTransformer("BAAI/bge-m3")
+from embedding import (
+    COLLECTION_METADATA,
+    is_current_collection,
+    load_embedding_model,
+)
+from answer_cache import clear_answer_cache
 
 load_dotenv()
 
@@ -17,17 +23,51 @@ load_dotenv()
 NOTES_PATH = os.getenv("NOTES_PATH", "./notes")
 CHROMA_PATH = os.getenv("CHROMA_PATH", "./chroma_data")
 
+# Precompiled patterns used by the chunking functions
+_TAG_RE = re.compile(r"^(:[\w-]+)+:$")
+_CODE_SPLIT_RE = re.compile(r"(```[\s\S]*?```)")
+_SECTION_SPLIT_RE = re.compile(r"(?=^## )", re.MULTILINE)
+_H2_RE = re.compile(r"^(## .+)$", re.MULTILINE)
+
+
+def walk_notes(root: str) -> Iterator[str]:
+    """Yield the paths of all .md files below root, skipping hidden entries."""
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                yield from walk_notes(entry.path)
+            elif entry.name.endswith(".md") and entry.is_file():
+                yield entry.path
+
+
+def read_note(path: str) -> str:
+    with open(path, "rb") as f:
+        # Tell the kernel the whole file is read sequentially (Linux only)
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        return f.read().decode("utf-8")
+
+
+def load_notes(paths: list[str]) -> list[dict]:
+    # Reads are I/O bound and release the GIL, so overlap them
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        texts = executor.map(read_note, paths)
+        return [
+            {
+                "path": path,
+                "content": text,
+                "sha": hashlib.sha256(text.encode("utf-8")).hexdigest(),
+            }
+            for path, text in zip(paths, texts)
+        ]
 
-def load_notes(notes_dir: str) -> list[dict]:
-    notes = []
-    for path in Path(notes_dir).rglob("*.md"):
-        # Skip hidden folders (those starting with .)
-        if any(part.startswith(".") for part in path.parts):
-            continue
 
-        text = path.read_text()
-        notes.append({"path": str(path), "content": text})
-    return notes
+def note_source(path: str) -> str:
+    """Return the path of a note relative to NOTES_PATH, as stored in Chroma."""
+    return path[len(NOTES_PATH) :]
 
 
 def extract_title(text: str) -> str:
@@ -37,52 +77,43 @@ def extract_title(text: str) -> str:
     return line.lstrip(" #")
 
 
-def extract_tags(text: str) -> list[str]:
-    """Extract tags from the last line if it matches :tag:tag: format."""
-    lines = text.strip().split("\n")
-    if not lines:
-        return []
-    last_line = lines[-1].strip()
-    if re.match(r"^(:[\w-]+)+:$", last_line):
-        return [t for t in last_line.split(":") if t]
-    return []
-
+def split_tag_line(text: str) -> tuple[str, list[str]]:
+    """Split the last line off text if it matches :tag:tag: format.
 
-def remove_tag_line(text: str) -> str:
-    """Remove the tag line from text."""
-    lines = text.strip().split("\n")
-    if not lines:
-        return text
-    last_line = lines[-1].strip()
-    if re.match(r"^(:[\w-]+)+:$", last_line):
-        return "\n".join(lines[:-1])
-    return text
+    Returns the text without the tag line and the tags. Only the last line is
+    split off, instead of splitting the whole note into lines.
+    """
+    body, _, last_line = text.strip().rpartition("\n")
+    last_line = last_line.strip()
+    if _TAG_RE.match(last_line):
+        return body, [t for t in last_line.split(":") if t]
+    return text, []
 
 
 def chunk_text(text: str, chunk_size: int = 500, overlap: int = 50) -> list[str]:
-    chunks = []
-    start = 0
-    while start < len(text):
-        end = start + chunk_size
-        chunks.append(text[start:end])
-        start = end - overlap
-    return chunks
+    starts = range(0, len(text), chunk_size - overlap)
+    return [text[start : start + chunk_size] for start in starts]
 
 
 def chunk_list(text: str, max_size: int = 1500) -> list[str]:
     lines = text.split("\n")
     chunks = []
-    current = ""
+    # Collect lines and join them per chunk, instead of growing a string
+    current = []
+    current_len = 0
 
     for line in lines:
         is_item = line.strip().startswith("- ")
-        if is_item and len(current) + len(line) > max_size and current:
-            chunks.append(current.strip())
-            current = ""
-        current += line + "\n"
-
-    if current.strip():
-        chunks.append(current.strip())
+        if is_item and current_len + len(line) > max_size and current:
+            chunks.append("\n".join(current).strip())
+            current = []
+            current_len = 0
+        current.append(line)
+        current_len += len(line) + 1
+
+    chunk = "\n".join(current).strip()
+    if chunk:
+        chunks.append(chunk)
     return chunks
 
 
@@ -93,16 +124,20 @@ def chunk_code_block(text: str, max_size: int = 1500) -> list[str]:
     lines = text.split("\n")
     header = lines[0]
     chunks = []
-    current = header + "\n"
+    # Collect lines and join them per chunk, instead of growing a string
+    current = [header]
+    current_len = len(header) + 1
 
     for line in lines[1:-1]:
-        if len(current) + len(line) > max_size and current != header + "\n":
-            chunks.append(current.rstrip() + "\n```")
-            current = header + "\n"
-        current += line + "\n"
+        if current_len + len(line) > max_size and len(current) > 1:
+            chunks.append("\n".join(current).rstrip() + "\n```")
+            current = [header]
+            current_len = len(header) + 1
+        current.append(line)
+        current_len += len(line) + 1
 
-    if current != header + "\n":
-        chunks.append(current.rstrip() + "\n```")
+    if len(current) > 1:
+        chunks.append("\n".join(current).rstrip() + "\n```")
 
     return chunks
 
@@ -116,7 +151,7 @@ def is_list_block(text: str) -> bool:
 
 
 def chunk_section(text: str, max_size: int = 1500) -> list[str]:
-    parts = re.split(r"(```[\s\S]*?```)", text)
+    parts = _CODE_SPLIT_RE.split(text)
 
     chunks = []
     for part in parts:
@@ -137,7 +172,7 @@ def chunk_section(text: str, max_size: int = 1500) -> list[str]:
 
 
 def chunk_markdown(text: str, max_size: int = 1500) -> list[str]:
-    sections = re.split(r"(?=^## )", text, flags=re.MULTILINE)
+    sections = _SECTION_SPLIT_RE.split(text)
 
     chunks = []
     for section in sections:
@@ -148,7 +183,7 @@ def chunk_markdown(text: str, max_size: int = 1500) -> list[str]:
         if len(section) <= max_size:
             chunks.append(section)
         else:
-            header_match = re.match(r"^(## .+)$", section, flags=re.MULTILINE)
+            header_match = _H2_RE.match(section)
             header = header_match.group(1) + "\n\n" if header_match else ""
             content = section[len(header) :].strip() if header else section
 
@@ -158,14 +193,19 @@ def chunk_markdown(text: str, max_size: int = 1500) -> list[str]:
     return chunks
 
 
+def chunk_preview(text: str, size: int = 200) -> str:
+    """Return the start of a chunk on a single line, as shown when re-ranking."""
+    preview = text[:size].replace("\n", " ")
+    return preview + "..." if len(text) > size else preview
+
+
 def chunk_notes(notes: list[dict]) -> list[dict]:
     chunks = []
     for note in notes:
         title = extract_title(note["content"])
-        tags = extract_tags(note["content"])
-        content = remove_tag_line(note["content"])
+        content, tags = split_tag_line(note["content"])
         tag_suffix = "\n\nTags: " + ", ".join(tags) if tags else ""
-        stripped_path = note["path"][len(NOTES_PATH) :]
+        stripped_path = note_source(note["path"])
 
         for i, chunk in enumerate(chunk_markdown(content)):
             chunks.append(
@@ -180,34 +220,118 @@ def chunk_notes(notes: list[dict]) -> list[dict]:
     return chunks
 
 
+def open_collection(client, rebuild: bool):
+    """Return the notes collection and whether it was (re)created empty.
+
+    The collection is recreated when asked to, or when it was built with
+    another embedding backend or chunk metadata format than the current one.
+    """
+    if not rebuild:
+        try:
+            collection = client.get_collection("notes")
+            if is_current_collection(collection.metadata):
+                return collection, False
+        except NotFoundError:
+            pass
+
+    try:
+        client.delete_collection("notes")
+    except NotFoundError:
+        pass
+    return client.create_collection("notes", metadata=COLLECTION_METADATA), True
+
+
 # Main
-notes = load_notes(NOTES_PATH)
-chunks = chunk_notes(notes)
+parser = argparse.ArgumentParser(description="Index notes into ChromaDB.")
+parser.add_argument(
+    "--full", action="store_true", help="re-index all notes, not only changed ones"
+)
+args = parser.parse_args()
 
 client = chromadb.PersistentClient(path=CHROMA_PATH)
-try:
-    client.delete_collection("notes")
-except NotFoundError:
-    pass
-
-collection = client.create_collection("notes")
-
-# Batch embedding for efficiency
-texts = [chunk["text"] for chunk in chunks]
-embeddings = model.encode(texts, show_progress_bar=True)
-
-for i, chunk in enumerate(chunks):
-    collection.add(
-        ids=[chunk["id"]],
-        embeddings=[embeddings[i].tolist()],
-        documents=[chunk["text"]],
-        metadatas=[
-            {
-                "title": chunk["title"],
-                "source": chunk["source"],
-                "tags": ",".join(chunk["tags"]),
-            }
-        ],
+collection, rebuilt = open_collection(client, rebuild=args.full)
+
+# Per-note modification time and content hash of the last indexing run
+state = sqlite3.connect(os.path.join(CHROMA_PATH, "index_state.sqlite"))
+state.execute(
+    "CREATE TABLE IF NOT EXISTS notes"
+    " (path TEXT PRIMARY KEY, mtime_ns INTEGER, sha TEXT)"
+)
+if rebuilt:
+    # Commit right away: if the rebuild is interrupted, the next run must see
+    # every note as new instead of trusting state for the old collection
+    with state:
+        state.execute("DELETE FROM notes")
+indexed = {
+    path: (mtime_ns, sha)
+    for path, mtime_ns, sha in state.execute("SELECT path, mtime_ns, sha FROM notes")
+}
+
+# Only read notes whose modification time changed, and only re-index
+# those whose content changed as well
+paths = list(walk_notes(NOTES_PATH))
+mtimes = {path: os.stat(path).st_mtime_ns for path in paths}
+touched = [
+    path
+    for path in paths
+    if path not in indexed or indexed[path][0] != mtimes[path]
+]
+notes = load_notes(touched)
+changed = [
+    note
+    for note in notes
+    if note["path"] not in indexed or indexed[note["path"]][1] != note["sha"]
+]
+removed = indexed.keys() - set(paths)
+
+stale_sources = [note_source(note["path"]) for note in changed]
+stale_sources += [note_source(path) for path in removed]
+if stale_sources and not rebuilt:
+    collection.delete(where={"source": {"$in": stale_sources}})
+
+chunks = chunk_notes(changed)
+if chunks:
+    # Load embedding model (must match the backend used by ask.py)
+    model = load_embedding_model()
+
+    # Batch embedding for efficiency
+    texts = [chunk["text"] for chunk in chunks]
+    embeddings = model.encode(texts, batch_size=32, show_progress_bar=True)
+
+    # Bulk insert, in slices no larger than Chroma accepts in one call
+    ids = [chunk["id"] for chunk in chunks]
+    metadatas = [
+        {
+            "title": chunk["title"],
+            "source": chunk["source"],
+            "tags": ",".join(chunk["tags"]),
+            "preview": chunk_preview(chunk["text"]),
+        }
+        for chunk in chunks
+    ]
+    batch_size = client.get_max_batch_size()
+    for start in range(0, len(chunks), batch_size):
+        end = start + batch_size
+        collection.add(
+            ids=ids[start:end],
+            embeddings=embeddings[start:end],
+            documents=texts[start:end],
+            metadatas=metadatas[start:end],
+        )
+
+with state:
+    state.executemany(
+        "INSERT OR REPLACE INTO notes (path, mtime_ns, sha) VALUES (?, ?, ?)",
+        [(note["path"], mtimes[note["path"]], note["sha"]) for note in notes],
     )
+    state.executemany("DELETE FROM notes WHERE path = ?", [(p,) for p in removed])
+state.close()
+
+if stale_sources:
+    # Cached answers may refer to notes that changed
+    clear_answer_cache()
 
-print(f"Indexed {len(chunks)} chunks from {len(notes)} notes")
+print(
+    f"Indexed {len(chunks)} chunks from {len(changed)} changed notes "
+    f"({len(removed)} removed, {len(paths) - len(changed)} unchanged)"
+)